@@ -1,11 +1,17 @@
 # This is a simple Azure Databricks API client that could be used to invoke the different
 # API endpoints like SCIM (to manage users & groups), clusters, workspace (to upload notebooks), 
 # jobs, permissions (preview) etc.
+#
+# The ids of the workspace objects created through this client are recorded in a run manifest,
+# so that they could be torn down later by azdbx_ws_teardown.py. The manifest path could be
+# overridden with the AZDBX_RUN_MANIFEST environment var.
 
 import os
 import json
 import requests
 import ssl
+import threading
+import time
 
 from requests.adapters import HTTPAdapter
 
@@ -28,9 +34,53 @@ class TlsV1HttpAdapter(HTTPAdapter):
     def init_poolmanager(self, connections, maxsize, block=False):
         self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize, block=block, ssl_version=ssl.PROTOCOL_TLSv1_2)
 
+# Rewrite a cluster spec to acquire its driver and worker nodes from an instance pool instead of
+# raw VMs. The node type and elastic disk settings come from the pool, so they are dropped from the spec.
+def use_instance_pool(cluster_spec, instance_pool_id):
+    cluster_spec.pop('node_type_id', None)
+    cluster_spec.pop('driver_node_type_id', None)
+    cluster_spec.pop('enable_elastic_disk', None)
+    cluster_spec['instance_pool_id'] = instance_pool_id
+    cluster_spec['driver_instance_pool_id'] = instance_pool_id
+    return cluster_spec
+
+# Get the number of nodes (driver included) a cluster spec requests when it starts
+def get_requested_node_count(cluster_spec):
+    if 'autoscale' in cluster_spec:
+        return cluster_spec['autoscale']['min_workers'] + 1
+    return cluster_spec.get('num_workers', 0) + 1
+
+# Load the source json of a workspace object (like a cluster or job spec) from workspace_object_src
+def load_workspace_object_source(source_file):
+    source_json_path = os.path.join(
+        os.path.dirname(__file__), 'workspace_object_src', source_file)
+    with open(source_json_path, 'r') as source_json_file:
+        return json.load(source_json_file)
+
+# The timeout of the requests sent by the retried APIs, so that a stuck connection is retried
+request_timeout_seconds = 60
+
+# The default path of the manifest of workspace objects created by a run
+default_run_manifest_path = os.path.join(os.path.dirname(__file__), 'workspace_objects_manifest.json')
+
+# The workspace object types recorded in the run manifest
+run_manifest_object_types = ["users", "groups", "group_memberships", "notebooks", "instance_pools",
+    "clusters", "jobs", "cluster_permissions", "job_permissions"]
+
+# Load the manifest of workspace objects created by a run, or an empty one if it doesn't exist yet
+def load_run_manifest(manifest_path):
+    manifest = {object_type: [] for object_type in run_manifest_object_types}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            manifest.update(json.load(manifest_file))
+    return manifest
+
 class DatabricksAPIClient(object):
 
     def __init__(self, adb_workspace_resource_id):
+        self.run_manifest_path = os.environ.get('AZDBX_RUN_MANIFEST', default_run_manifest_path)
+        self.run_manifest_lock = threading.Lock()
+
         self.session = requests.Session()
         self.session.mount('https://', TlsV1HttpAdapter())
 
@@ -50,14 +100,83 @@ class DatabricksAPIClient(object):
     def get_url_prefix(self):
         return self.url_prefix
 
+    # Utility method to send a request to an API on the Azure Databricks workspace base endpoint
+    def send_request(self, method, api_endpoint, payload, timeout=None):
+        return self.session.request(method, self.url_prefix + api_endpoint,
+            data=json.dumps(payload) if payload is not None else None, verify = True, headers = self.headers,
+            timeout = timeout)
+
     # Utility method to invoke different APIs on the Azure Databricks workspace base endpoint
     def invoke_request(self, method, api_endpoint, payload):
-        resp = self.session.request(method, self.url_prefix + api_endpoint, data=json.dumps(payload), 
-            verify = True, headers = self.headers)
+        resp = self.send_request(method, api_endpoint, payload)
         print("API response status code is {}".format(resp.status_code))
         resp_json = resp.json()
         return resp_json
 
+    # Utility method to invoke an API and check that it succeeded, i.e. that it returned a 2xx status
+    # code and no error_code, as the outcome of some APIs is only reported in the response body
+    def invoke_request_and_check(self, method, api_endpoint, payload):
+        resp = self.send_request(method, api_endpoint, payload)
+        print("API response status code is {}".format(resp.status_code))
+        try:
+            resp_json = resp.json()
+        except ValueError:
+            resp_json = {}
+        return 200 <= resp.status_code < 300 and 'error_code' not in resp_json
+
+    # Utility method to invoke the delete/remove APIs so that they could be safely retried. A object
+    # that doesn't exist (anymore) is considered as already deleted, and failed requests are retried
+    # with an exponential backoff. Returns True if the object was deleted, and False if it didn't exist.
+    def invoke_idempotent_request(self, method, api_endpoint, payload, max_retries=5,
+            missing_object_error_codes=()):
+        resp = self.invoke_request_with_retries(method, api_endpoint, payload, max_retries,
+            missing_object_error_codes)
+        return resp is not None
+
+    # Utility method to invoke an API with retries of connection errors, timeouts, and throttled or failed
+    # requests, using an exponential backoff. Returns the response, or None if the object doesn't exist,
+    # and raises an exception on any other error. A missing object is reported with a 404 status code or a
+    # RESOURCE_DOES_NOT_EXIST error code, though some APIs report it with another error code (given in
+    # missing_object_error_codes) and a "does not exist" message.
+    def invoke_request_with_retries(self, method, api_endpoint, payload, max_retries=5,
+            missing_object_error_codes=()):
+        for attempt in range(max_retries + 1):
+            try:
+                resp = self.send_request(method, api_endpoint, payload, timeout=request_timeout_seconds)
+            except requests.exceptions.RequestException as e:
+                if attempt < max_retries:
+                    print("API request failed with {} for {} {}, retrying".format(e, method, api_endpoint))
+                    time.sleep(2 ** attempt)
+                    continue
+                raise
+            if resp.status_code < 300:
+                return resp
+            try:
+                resp_json = resp.json()
+            except ValueError:
+                resp_json = {}
+            error_code = resp_json.get('error_code')
+            if resp.status_code == 404 or error_code == 'RESOURCE_DOES_NOT_EXIST' or \
+                    (error_code in missing_object_error_codes and 'does not exist' in resp_json.get('message', '')):
+                print("The object for {} {} does not exist, nothing to do".format(method, api_endpoint))
+                return None
+            if (resp.status_code == 429 or resp.status_code >= 500) and attempt < max_retries:
+                print("API response status code is {} for {} {}, retrying".format(resp.status_code,
+                    method, api_endpoint))
+                time.sleep(2 ** attempt)
+                continue
+            raise Exception("Failed to {} {} with status code {}: {}".format(method, api_endpoint,
+                resp.status_code, resp.text))
+
+    # Record a workspace object created by this run in the run manifest
+    def record_created_object(self, object_type, object_ref):
+        with self.run_manifest_lock:
+            manifest = load_run_manifest(self.run_manifest_path)
+            if object_ref not in manifest[object_type]:
+                manifest[object_type].append(object_ref)
+            with open(self.run_manifest_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=4)
+
     # Invoke the SCIM /Users API to provision a user in the Azure Databricks workspace
     def create_user(self, user_name, assign_cluster_create):
         api_endpoint = "/preview/scim/v2/Users"
@@ -82,6 +201,7 @@ class DatabricksAPIClient(object):
             }
         resp_json = self.invoke_request('POST', api_endpoint, payload)
         print("Added the user {} with id {}".format(user_name, resp_json['id']))
+        self.record_created_object("users", {"id": resp_json['id'], "user_name": user_name})
         return resp_json['id']
 
     # Invoke the SCIM /Groups API to provision a group in the Azure Databricks workspace
@@ -95,6 +215,7 @@ class DatabricksAPIClient(object):
         }
         resp_json = self.invoke_request('POST', api_endpoint, payload)
         print("Added the group {} with id {}".format(group_name, resp_json['id']))
+        self.record_created_object("groups", {"id": resp_json['id'], "group_name": group_name})
         return resp_json['id']
 
     # Invoke the SCIM /Groups API to get the "admins" group id
@@ -127,8 +248,39 @@ class DatabricksAPIClient(object):
                 }
             ]
         }
-        self.invoke_request('PATCH', api_endpoint + "/" + group_id, payload)
+        succeeded = self.invoke_request_and_check('PATCH', api_endpoint + "/" + group_id, payload)
         print("Added the user {} to group {}".format(user_id, group_id))
+        if succeeded:
+            self.record_created_object("group_memberships", {"user_id": user_id, "group_id": group_id})
+
+    # Invoke the SCIM /Users API to delete a user from the Azure Databricks workspace
+    def delete_user(self, user_id):
+        api_endpoint = "/preview/scim/v2/Users/" + user_id
+        if self.invoke_idempotent_request('DELETE', api_endpoint, {}):
+            print("Deleted the user {}".format(user_id))
+
+    # Invoke the SCIM /Groups API to delete a group from the Azure Databricks workspace
+    def delete_group(self, group_id):
+        api_endpoint = "/preview/scim/v2/Groups/" + group_id
+        if self.invoke_idempotent_request('DELETE', api_endpoint, {}):
+            print("Deleted the group {}".format(group_id))
+
+    # Invoke the SCIM /Groups API to remove a user from a group in the Azure Databricks workspace
+    def remove_user_from_group(self, user_id, group_id):
+        api_endpoint = "/preview/scim/v2/Groups/" + group_id
+        payload = {
+            "schemas":[
+                "urn:ietf:params:scim:api:messages:2.0:PatchOp"
+            ],
+            "Operations":[
+                {
+                    "op": "remove",
+                    "path": "members[value eq \"" + user_id + "\"]"
+                }
+            ]
+        }
+        if self.invoke_idempotent_request('PATCH', api_endpoint, payload):
+            print("Removed the user {} from group {}".format(user_id, group_id))
 
     # Invoke the /workspace/import API to import a notebook into a user's sandbox 
     # in a Azure Databricks workspace
@@ -141,35 +293,195 @@ class DatabricksAPIClient(object):
             "content": src_nb_content,
             "overwrite": False
         }
-        self.invoke_request('POST', api_endpoint, payload)
+        succeeded = self.invoke_request_and_check('POST', api_endpoint, payload)
         print("Imported the notebook {} in the workspace".format(dest_nb_path))
+        if succeeded:
+            self.record_created_object("notebooks", dest_nb_path)
+
+    # Invoke the /workspace/delete API to delete a notebook from the Azure Databricks workspace
+    def delete_notebook(self, nb_path):
+        api_endpoint = '/workspace/delete'
+        payload = {
+            "path": nb_path,
+            "recursive": False
+        }
+        if self.invoke_idempotent_request('POST', api_endpoint, payload):
+            print("Deleted the notebook {} from the workspace".format(nb_path))
+
+    # Invoke the /instance-pools/create API to create an instance pool in a Azure Databricks workspace
+    def create_instance_pool(self, instance_pool_source_file):
+        api_endpoint = '/instance-pools/create'
+        payload = load_workspace_object_source(instance_pool_source_file)
+        resp_json = self.invoke_request('POST', api_endpoint, payload)
+        print("Created the instance pool for source json in {} with id {}".format(instance_pool_source_file,
+            resp_json['instance_pool_id']))
+        self.record_created_object("instance_pools", resp_json['instance_pool_id'])
+        return resp_json['instance_pool_id']
+
+    # Invoke the /instance-pools/delete API to delete an instance pool in a Azure Databricks workspace
+    def delete_instance_pool(self, instance_pool_id):
+        api_endpoint = '/instance-pools/delete'
+        payload = {
+            "instance_pool_id": instance_pool_id
+        }
+        # An instance pool that doesn't exist is reported with an INVALID_PARAMETER_VALUE error code
+        if self.invoke_idempotent_request('POST', api_endpoint, payload,
+                missing_object_error_codes=('INVALID_PARAMETER_VALUE',)):
+            print("Deleted the instance pool {}".format(instance_pool_id))
+
+    # Invoke the /instance-pools/get API to get the settings and stats of an instance pool
+    def get_instance_pool(self, instance_pool_id):
+        api_endpoint = '/instance-pools/get?instance_pool_id=' + instance_pool_id
+        return self.invoke_request('GET', api_endpoint, {})
+
+    # Get the usage stats (used, idle and pending instance counts) of an instance pool
+    def get_instance_pool_stats(self, instance_pool_id):
+        instance_pool = self.get_instance_pool(instance_pool_id)
+        return instance_pool.get('stats', {})
+
+    # Get the number of idle instances currently available in an instance pool
+    def get_instance_pool_idle_count(self, instance_pool_id):
+        return self.get_instance_pool_stats(instance_pool_id).get('idle_count', 0)
+
+    # Poll an instance pool until it has at least the given number of idle instances, so that
+    # the clusters created on it right after do not pay the VM acquisition time
+    def wait_for_instance_pool_idle_instances(self, instance_pool_id, min_idle_instances,
+            poll_interval_seconds=10, timeout_seconds=1200):
+        start_time = time.time()
+        while time.time() - start_time < timeout_seconds:
+            idle_count = self.get_instance_pool_idle_count(instance_pool_id)
+            if idle_count >= min_idle_instances:
+                print("The instance pool {} has {} idle instances after {} seconds".format(instance_pool_id,
+                    idle_count, str(int(time.time() - start_time))))
+                return idle_count
+            time.sleep(poll_interval_seconds)
+        print("The instance pool {} did not reach {} idle instances in {} seconds".format(instance_pool_id,
+            min_idle_instances, timeout_seconds))
+        return self.get_instance_pool_idle_count(instance_pool_id)
+
+    # Invoke the /clusters/get API to get the state of a cluster
+    def get_cluster_state(self, cluster_id):
+        api_endpoint = '/clusters/get?cluster_id=' + cluster_id
+        resp_json = self.invoke_request('GET', api_endpoint, {})
+        return resp_json['state']
+
+    # Poll a cluster until it's running, and return the seconds it took since the given start time
+    # If an on_poll function is given, it's called on every poll while the cluster is starting
+    def wait_for_cluster_running(self, cluster_id, start_time, poll_interval_seconds=10, timeout_seconds=1800,
+            on_poll=None):
+        while time.time() - start_time < timeout_seconds:
+            if on_poll is not None:
+                on_poll()
+            state = self.get_cluster_state(cluster_id)
+            if state == 'RUNNING':
+                time_to_ready = time.time() - start_time
+                print("The cluster {} was ready in {} seconds".format(cluster_id, str(int(time_to_ready))))
+                return time_to_ready
+            if state in ('TERMINATING', 'TERMINATED', 'ERROR', 'UNKNOWN'):
+                raise Exception("The cluster {} failed to start and is in state {}".format(cluster_id, state))
+            time.sleep(poll_interval_seconds)
+        raise Exception("The cluster {} was not ready in {} seconds".format(cluster_id, timeout_seconds))
+
+    # Create a cluster from its source json on an instance pool, wait until it's running, and report
+    # the pool hit rate and the time-to-ready. The instances the cluster got from the pool are measured
+    # from the pool's used count, and the instances the pool had to acquire for it (the misses) from the
+    # peak of the pool's pending used count, sampled while the cluster is starting. The hit rate is only
+    # accurate if nothing else is using the pool at the same time.
+    # If a non-pooled time-to-ready is given, the speedup of the pooled path is reported as well.
+    def create_pooled_cluster_and_report(self, cluster_source_file, instance_pool_id, non_pooled_time_to_ready=None):
+        cluster_spec = load_workspace_object_source(cluster_source_file)
+        requested_node_count = get_requested_node_count(cluster_spec)
+        use_instance_pool(cluster_spec, instance_pool_id)
+        stats_before = self.get_instance_pool_stats(instance_pool_id)
+        pending_used_counts = [stats_before.get('pending_used_count', 0)]
+
+        def sample_pending_used_count():
+            pending_used_counts.append(self.get_instance_pool_stats(instance_pool_id).get('pending_used_count', 0))
+
+        start_time = time.time()
+        cluster_id = self.create_cluster_from_spec(cluster_spec, cluster_source_file)
+        time_to_ready = self.wait_for_cluster_running(cluster_id, start_time, on_poll=sample_pending_used_count)
+        stats_after = self.get_instance_pool_stats(instance_pool_id)
+        pool_used_count = stats_after.get('used_count', 0) - stats_before.get('used_count', 0)
+        pool_miss_count = min(max(pending_used_counts) - pending_used_counts[0], pool_used_count)
+        pool_hit_count = pool_used_count - pool_miss_count
+        report = {
+            "cluster_id": cluster_id,
+            "instance_pool_id": instance_pool_id,
+            "requested_node_count": requested_node_count,
+            "pool_used_count": pool_used_count,
+            "pool_hit_count": pool_hit_count,
+            "pool_miss_count": pool_miss_count,
+            "pool_hit_rate": float(pool_hit_count) / pool_used_count if pool_used_count > 0 else None,
+            "time_to_ready_seconds": time_to_ready
+        }
+        if report['pool_hit_rate'] is not None:
+            print("Cluster {} got {} of {} requested nodes from instance pool {}, {} from idle instances "
+                "(hit rate {:.0%}) and {} newly acquired, ready in {} seconds".format(cluster_id, pool_used_count,
+                requested_node_count, instance_pool_id, pool_hit_count, report['pool_hit_rate'], pool_miss_count,
+                str(int(time_to_ready))))
+        else:
+            print("Cluster {} got no instances from instance pool {}, ready in {} seconds".format(cluster_id,
+                instance_pool_id, str(int(time_to_ready))))
+        if non_pooled_time_to_ready is not None:
+            report['non_pooled_time_to_ready_seconds'] = non_pooled_time_to_ready
+            report['time_to_ready_speedup'] = non_pooled_time_to_ready / time_to_ready
+            print("The non-pooled cluster was ready in {} seconds, the pooled one was {:.1f}x faster".format(
+                str(int(non_pooled_time_to_ready)), report['time_to_ready_speedup']))
+        return report
 
     # Invoke the /clusters/create API to create a cluster in a Azure Databricks workspace
-    def create_cluster(self, cluster_source_file):
+    # If an instance pool id is given, the cluster nodes are acquired from that pool
+    def create_cluster(self, cluster_source_file, instance_pool_id=None):
+        cluster_spec = load_workspace_object_source(cluster_source_file)
+        if instance_pool_id is not None:
+            use_instance_pool(cluster_spec, instance_pool_id)
+        return self.create_cluster_from_spec(cluster_spec, cluster_source_file)
+
+    # Invoke the /clusters/create API to create a cluster from an already loaded cluster spec
+    def create_cluster_from_spec(self, cluster_spec, cluster_source_file):
         api_endpoint = '/clusters/create'
-        payload = None
-        cluster_json_path = os.path.join(
-            os.path.dirname(__file__), 'workspace_object_src', cluster_source_file)
-        with open(cluster_json_path, 'r') as cluster_json_file:
-            payload = json.load(cluster_json_file)
-        resp_json = self.invoke_request('POST', api_endpoint, payload)
+        resp_json = self.invoke_request('POST', api_endpoint, cluster_spec)
         print("Created the cluster for source json in {} with id {}".format(cluster_source_file, 
             resp_json['cluster_id']))
+        self.record_created_object("clusters", resp_json['cluster_id'])
         return resp_json['cluster_id']
 
+    # Invoke the /clusters/permanent-delete API to delete a cluster in a Azure Databricks workspace
+    def permanent_delete_cluster(self, cluster_id):
+        api_endpoint = '/clusters/permanent-delete'
+        payload = {
+            "cluster_id": cluster_id
+        }
+        # A cluster that doesn't exist is reported with an INVALID_PARAMETER_VALUE error code
+        if self.invoke_idempotent_request('POST', api_endpoint, payload,
+                missing_object_error_codes=('INVALID_PARAMETER_VALUE',)):
+            print("Deleted the cluster {}".format(cluster_id))
+
     # Invoke the /jobs/create API to create a job in a Azure Databricks workspace
-    def create_job(self, job_source_file):
+    # If an instance pool id is given, the job's new cluster nodes are acquired from that pool
+    def create_job(self, job_source_file, instance_pool_id=None):
         api_endpoint = '/jobs/create'
-        payload = None
-        job_json_path = os.path.join(
-            os.path.dirname(__file__), 'workspace_object_src', job_source_file)
-        with open(job_json_path, 'r') as job_json_file:
-            payload = json.load(job_json_file)
+        payload = load_workspace_object_source(job_source_file)
+        if instance_pool_id is not None and 'new_cluster' in payload:
+            use_instance_pool(payload['new_cluster'], instance_pool_id)
         resp_json = self.invoke_request('POST', api_endpoint, payload)
         print("Created the job for source json in {} with id {}".format(job_source_file, 
             resp_json['job_id']))
+        self.record_created_object("jobs", str(resp_json['job_id']))
         return str(resp_json['job_id'])
 
+    # Invoke the /jobs/delete API to delete a job in a Azure Databricks workspace
+    def delete_job(self, job_id):
+        api_endpoint = '/jobs/delete'
+        payload = {
+            "job_id": int(job_id)
+        }
+        # A job that doesn't exist is reported with an INVALID_PARAMETER_VALUE error code
+        if self.invoke_idempotent_request('POST', api_endpoint, payload,
+                missing_object_error_codes=('INVALID_PARAMETER_VALUE',)):
+            print("Deleted the job {}".format(job_id))
+
     # Invoke the preview /permission/clusters API to set permission for a user on a cluster
     def set_permission_on_cluster(self, cluster_id, user_name, permission):
         api_endpoint = "/preview/permissions/clusters/" + cluster_id
@@ -181,8 +493,10 @@ class DatabricksAPIClient(object):
                 }
             ]
         }
-        self.invoke_request('PUT', api_endpoint, payload)
+        succeeded = self.invoke_request_and_check('PUT', api_endpoint, payload)
         print ("Applied permission {} for user {} on cluster {}".format(permission, user_name, cluster_id))
+        if succeeded:
+            self.record_created_object("cluster_permissions", {"cluster_id": cluster_id, "user_name": user_name})
     
     # Invoke the preview /permission/jobs API to set permission for a user on a job
     def set_permission_on_job(self, job_id, user_name, permission):
@@ -195,5 +509,39 @@ class DatabricksAPIClient(object):
                 }
             ]
         }
-        self.invoke_request('PATCH', api_endpoint, payload)
+        succeeded = self.invoke_request_and_check('PATCH', api_endpoint, payload)
         print ("Applied permission {} for user {} on job {}".format(permission, user_name, job_id))
+        if succeeded:
+            self.record_created_object("job_permissions", {"job_id": job_id, "user_name": user_name})
+
+    # Invoke the preview /permissions API to remove the direct permissions of users on a cluster or job
+    # The Permissions PUT API replaces the whole access control list, so the existing direct (not inherited)
+    # permissions of all other principals, including the job owner, are set again in the payload
+    def remove_user_permissions(self, object_type, object_id, user_names):
+        api_endpoint = "/preview/permissions/" + object_type + "/" + object_id
+        # A cluster or job that doesn't exist is reported with an INVALID_PARAMETER_VALUE error code
+        resp = self.invoke_request_with_retries('GET', api_endpoint, None,
+            missing_object_error_codes=('INVALID_PARAMETER_VALUE',))
+        if resp is None:
+            return
+        if resp.status_code != 200:
+            raise Exception("Failed to get the permissions on {} {} with status code {}: {}".format(object_type,
+                object_id, resp.status_code, resp.text))
+        access_control_list = []
+        for acl_entry in resp.json().get('access_control_list', []):
+            if acl_entry.get('user_name') in user_names:
+                continue
+            for principal_key in ('user_name', 'group_name', 'service_principal_name'):
+                if principal_key in acl_entry:
+                    for acl_permission in acl_entry.get('all_permissions', []):
+                        if not acl_permission.get('inherited', False):
+                            access_control_list.append({
+                                principal_key: acl_entry[principal_key],
+                                "permission_level": acl_permission['permission_level']
+                            })
+        payload = {
+            "access_control_list": access_control_list
+        }
+        if self.invoke_idempotent_request('PUT', api_endpoint, payload,
+                missing_object_error_codes=('INVALID_PARAMETER_VALUE',)):
+            print ("Removed permissions for users {} on {} {}".format(", ".join(user_names), object_type, object_id))
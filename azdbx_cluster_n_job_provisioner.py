@@ -7,9 +7,13 @@
 #
 # AZURE_SUBSCRIPTION_ID: with your Azure Subscription Id
 # AZURE_RESOURCE_GROUP: with your Azure Resource Group
+#
+# Optionally set AZDBX_COMPARE_NON_POOLED to true to also start a throwaway cluster on raw VMs, and
+# report the time-to-ready of the instance pool-backed cluster compared to it.
 
 import os
 import json
+import time
 
 from azdbx_api_client import DatabricksAPIClient
 
@@ -31,15 +35,33 @@ print("The workspace resource id is {}".format(adb_workspace_resource_id))
 databricks_api_client = DatabricksAPIClient(adb_workspace_resource_id)
 print("The workspace URL is {}".format(databricks_api_client.get_url_prefix()))
 
-# Create a high-concurrency cluster to analyze processed data
-cluster_id = databricks_api_client.create_cluster("high_concurrency_cluster.json")
+# Create an instance pool with idle instances, so that cluster starts and job runs
+# don't pay the full VM acquisition time
+instance_pool_id = databricks_api_client.create_instance_pool("standard_instance_pool.json")
+min_idle_instances = databricks_api_client.get_instance_pool(instance_pool_id)['min_idle_instances']
+databricks_api_client.wait_for_instance_pool_idle_instances(instance_pool_id, min_idle_instances)
+
+# Optionally measure the time-to-ready of the cluster on raw VMs, to compare with the pooled one
+non_pooled_time_to_ready = None
+if os.environ.get('AZDBX_COMPARE_NON_POOLED', 'false').lower() == 'true':
+    start_time = time.time()
+    non_pooled_cluster_id = databricks_api_client.create_cluster("high_concurrency_cluster.json")
+    try:
+        non_pooled_time_to_ready = databricks_api_client.wait_for_cluster_running(non_pooled_cluster_id, start_time)
+    finally:
+        databricks_api_client.permanent_delete_cluster(non_pooled_cluster_id)
+
+# Create a high-concurrency cluster on the instance pool to analyze processed data
+pool_report = databricks_api_client.create_pooled_cluster_and_report("high_concurrency_cluster.json",
+    instance_pool_id, non_pooled_time_to_ready)
+cluster_id = pool_report['cluster_id']
 
 # Set permissions for users on the cluster
 databricks_api_client.set_permission_on_cluster(cluster_id, "a.g@databricks.com", "CAN_MANAGE")
 databricks_api_client.set_permission_on_cluster(cluster_id, "ag@gmail.com", "CAN_ATTACH_TO")
 
-# Create a on-demand job to run a notebook
-job_id = databricks_api_client.create_job("standard_cluster_job.json")
+# Create a on-demand job to run a notebook, with its new cluster on the instance pool
+job_id = databricks_api_client.create_job("standard_cluster_job.json", instance_pool_id)
 
 # Set permissions for users on the job
 databricks_api_client.set_permission_on_job(job_id, "a.g@databricks.com", "CAN_MANAGE")
@@ -1,10 +1,13 @@
 # This script is a non-modular sample solution for how to deploy an Log Analytics workspace,
 # and then deploy an Azure Databricks NPIP workspace with diagnostic logs configured to be sent
-# to the Log Analytics workspace.
+# to the Log Analytics workspace. While each deployment is running, its operations are polled to
+# build a per-resource timeline, which is written as a JSON report under deployment_reports/.
 
 import os.path
 import json
-import time
+import re
+
+from datetime import datetime, timedelta, timezone
 
 from azure.common.credentials import ServicePrincipalCredentials
 from azure.mgmt.resource import ResourceManagementClient
@@ -32,6 +35,124 @@ credentials = ServicePrincipalCredentials(
 )
 client = ResourceManagementClient(credentials, subscription_id)
 
+# How often the deployment operations are polled while waiting for a deployment
+operation_poll_interval_seconds = 10
+
+# Directory where the per-resource deployment timeline reports are written
+deployment_reports_dir = os.path.join(os.path.dirname(__file__), 'deployment_reports')
+
+# Parse an ISO 8601 duration like PT1M5.25S (as returned for deployment operations) to seconds
+def parse_operation_duration(duration):
+    if not duration:
+        return None
+    match = re.match(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$', duration)
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+# Get the latest state of all operations of a deployment, and merge it into the timeline
+# collected so far. The operation timestamp is the time of its last update, so the start
+# time is derived from its duration, else from the time the operation was first observed.
+def collect_deployment_operations(deployment_name, timeline):
+    now = datetime.now(timezone.utc)
+    for operation in client.deployment_operations.list(resource_group, deployment_name):
+        properties = operation.properties
+        target_resource = properties.target_resource
+        if target_resource is None:
+            # Skip the operations not tied to a resource, like the deployment output evaluation
+            continue
+        entry = timeline.setdefault(operation.operation_id, {
+            'resourceType': target_resource.resource_type,
+            'resourceName': target_resource.resource_name,
+            'resourceId': target_resource.id,
+            'firstSeen': now
+        })
+        entry['provisioningState'] = properties.provisioning_state
+        duration = parse_operation_duration(properties.duration)
+        if duration is not None and properties.timestamp is not None:
+            entry['endTime'] = properties.timestamp
+            entry['startTime'] = properties.timestamp - timedelta(seconds=duration)
+        else:
+            entry['startTime'] = entry['firstSeen']
+            entry['endTime'] = now
+        entry['durationSeconds'] = (entry['endTime'] - entry['startTime']).total_seconds()
+
+# Write the per-resource timeline of a deployment as a JSON report. The traceEvents section uses
+# the Trace Event format, so the report could be loaded as a flame chart in chrome://tracing or
+# https://www.speedscope.app to see which resources are on the critical path.
+def write_deployment_timeline_report(deployment_name, deployment_start, deployment_end, timeline):
+    resources = sorted(timeline.values(), key=lambda entry: entry['startTime'])
+    report = {
+        'deployment': deployment_name,
+        'resourceGroup': resource_group,
+        'startTime': deployment_start.isoformat(),
+        'endTime': deployment_end.isoformat(),
+        'durationSeconds': (deployment_end - deployment_start).total_seconds(),
+        'resources': [],
+        'traceEvents': []
+    }
+    for index, entry in enumerate(resources):
+        report['resources'].append({
+            'resourceType': entry['resourceType'],
+            'resourceName': entry['resourceName'],
+            'resourceId': entry['resourceId'],
+            'provisioningState': entry['provisioningState'],
+            'startTime': entry['startTime'].isoformat(),
+            'endTime': entry['endTime'].isoformat(),
+            'durationSeconds': entry['durationSeconds']
+        })
+        report['traceEvents'].append({
+            'name': entry['resourceType'] + '/' + entry['resourceName'],
+            'cat': entry['resourceType'],
+            'ph': 'X',
+            'ts': int((entry['startTime'] - deployment_start).total_seconds() * 1000000),
+            'dur': int(entry['durationSeconds'] * 1000000),
+            'pid': deployment_name,
+            'tid': index,
+            'args': {'provisioningState': entry['provisioningState']}
+        })
+
+    if not os.path.isdir(deployment_reports_dir):
+        os.makedirs(deployment_reports_dir)
+    report_path = os.path.join(deployment_reports_dir, deployment_name + '_timeline.json')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+    print("Per-resource timeline for deployment {}, slowest first:".format(deployment_name))
+    for entry in sorted(resources, key=lambda entry: entry['durationSeconds'], reverse=True):
+        print("  {}/{} {} in {} seconds".format(entry['resourceType'], entry['resourceName'],
+            entry['provisioningState'], str(int(entry['durationSeconds']))))
+    print("Wrote the deployment timeline report to {}".format(report_path))
+    return report
+
+# Deploy a template, polling its operations while waiting to build the per-resource timeline
+# The timeline report is written even if the deployment fails, as that's when it matters the most
+def deploy_template(deployment_name, deployment_properties):
+    timeline = {}
+    deployment_start = datetime.now(timezone.utc)
+    deployment_async_operation = client.deployments.create_or_update(
+        resource_group,
+        deployment_name,
+        Deployment(properties=deployment_properties)
+    )
+    try:
+        while not deployment_async_operation.done():
+            deployment_async_operation.wait(operation_poll_interval_seconds)
+            collect_deployment_operations(deployment_name, timeline)
+    finally:
+        deployment_end = datetime.now(timezone.utc)
+        report = {'durationSeconds': (deployment_end - deployment_start).total_seconds()}
+        # Get the final state of the operations that completed since the last poll. A failure here is
+        # only logged, so that it doesn't hide the outcome of the deployment itself.
+        try:
+            collect_deployment_operations(deployment_name, timeline)
+            report = write_deployment_timeline_report(deployment_name, deployment_start, deployment_end, timeline)
+        except Exception as e:
+            print("Failed to write the timeline report for deployment {}: {}".format(deployment_name, e))
+    deployment_async_operation.result()
+    return report
+
 # Get the Log Analytics Workspace Template
 la_template_body = None
 la_template_path = os.path.join(
@@ -53,15 +174,9 @@ la_deployment_properties = DeploymentProperties(mode=DeploymentMode.incremental,
 
 print("Deploying Log Analytics Workspace {} in resource group {}".format(
     la_template_parameters['name']['value'], resource_group))
-start_time = time.time()
-la_deployment_async_operation = client.deployments.create_or_update(
-    resource_group,
-    'adb-e2-automation-la-deploy',
-    Deployment(properties=la_deployment_properties)
-)
-la_deployment_async_operation.wait()
-end_time = time.time()
-print("Deployed the Log Analytics Workspace in {} seconds".format(str(int(end_time - start_time))))
+la_deployment_report = deploy_template('adb-e2-automation-la-deploy', la_deployment_properties)
+print("Deployed the Log Analytics Workspace in {} seconds".format(
+    str(int(la_deployment_report['durationSeconds']))))
 
 # Get the Azure Databricks Workspace Template
 adb_template_body = None
@@ -87,12 +202,6 @@ adb_deployment_properties = DeploymentProperties(mode=DeploymentMode.incremental
 
 print("Deploying Azure Databricks Workspace {} in resource group {}".format(
     adb_template_parameters['workspaceName']['value'], resource_group))
-start_time = time.time()
-adb_deployment_async_operation = client.deployments.create_or_update(
-    resource_group,
-    'adb-e2-automation-adbws-deploy',
-    Deployment(properties=adb_deployment_properties)
-)
-adb_deployment_async_operation.wait()
-end_time = time.time()
-print("Deployed the Azure Databricks Workspace in {} seconds".format(str(int(end_time - start_time))))
+adb_deployment_report = deploy_template('adb-e2-automation-adbws-deploy', adb_deployment_properties)
+print("Deployed the Azure Databricks Workspace in {} seconds".format(
+    str(int(adb_deployment_report['durationSeconds']))))
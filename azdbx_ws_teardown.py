@@ -0,0 +1,101 @@
+# This is a sample solution for how to tear down the workspace objects provisioned by the other
+# scripts, so that short-lived (e.g. CI) environments could be cleaned up after every run. The objects
+# to delete are read from the run manifest recorded by the Databricks API client, and are deleted
+# concurrently in dependency order: permissions, then jobs and clusters, then group memberships,
+# notebooks and instance pools, and then users and groups. All deletes are idempotent, so the
+# script could be safely re-run if a stage fails.
+
+# This script expects that the following environment vars are set:
+#
+# AZURE_SUBSCRIPTION_ID: with your Azure Subscription Id
+# AZURE_RESOURCE_GROUP: with your Azure Resource Group
+#
+# Optionally set AZDBX_TEARDOWN_WORKERS to the number of concurrent delete requests (default 8).
+
+import os
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from azdbx_api_client import DatabricksAPIClient, load_run_manifest
+
+# Get the Azure Databricks template parameters to get the deployed workspace's name
+adb_template_parameters = None
+adb_template_params_path = os.path.join(
+    os.path.dirname(__file__), 'arm_template_params', 'azure_databricks_npip_template_params.json')
+with open(adb_template_params_path, 'r') as adb_template_params_file:
+    adb_template_parameters = json.load(adb_template_params_file)
+
+# Form the full resource id of the Azure Databricks workspace
+adb_workspace_resource_id = "/subscriptions/" + os.environ.get(
+    'AZURE_SUBSCRIPTION_ID', '11111111-1111-1111-1111-111111111111') + "/resourceGroups/" + \
+    os.environ.get('AZURE_RESOURCE_GROUP', 'my-adb-e2-rg') + "/providers/Microsoft.Databricks/workspaces/" + \
+    adb_template_parameters['workspaceName']
+print("The workspace resource id is {}".format(adb_workspace_resource_id))
+
+# Create the Databricks API client
+databricks_api_client = DatabricksAPIClient(adb_workspace_resource_id)
+print("The workspace URL is {}".format(databricks_api_client.get_url_prefix()))
+
+# Get the workspace objects created by the provisioning runs
+manifest = load_run_manifest(databricks_api_client.run_manifest_path)
+
+# Group the recorded permissions by object, as the Permissions API replaces the whole access control
+# list of an object, and concurrent updates of the same object would overwrite each other
+cluster_permission_users = {}
+for cluster_permission in manifest['cluster_permissions']:
+    cluster_permission_users.setdefault(cluster_permission['cluster_id'], []).append(
+        cluster_permission['user_name'])
+job_permission_users = {}
+for job_permission in manifest['job_permissions']:
+    job_permission_users.setdefault(job_permission['job_id'], []).append(job_permission['user_name'])
+
+# The teardown stages in dependency order, where the deletes within a stage are independent
+teardown_stages = [
+    ("permissions",
+        [(databricks_api_client.remove_user_permissions, 'clusters', cluster_id, user_names)
+            for cluster_id, user_names in cluster_permission_users.items()] +
+        [(databricks_api_client.remove_user_permissions, 'jobs', job_id, user_names)
+            for job_id, user_names in job_permission_users.items()]),
+    ("jobs and clusters",
+        [(databricks_api_client.delete_job, job_id) for job_id in manifest['jobs']] +
+        [(databricks_api_client.permanent_delete_cluster, cluster_id) for cluster_id in manifest['clusters']]),
+    ("group memberships, notebooks and instance pools",
+        [(databricks_api_client.remove_user_from_group, membership['user_id'], membership['group_id'])
+            for membership in manifest['group_memberships']] +
+        [(databricks_api_client.delete_notebook, nb_path) for nb_path in manifest['notebooks']] +
+        [(databricks_api_client.delete_instance_pool, instance_pool_id)
+            for instance_pool_id in manifest['instance_pools']]),
+    ("users and groups",
+        [(databricks_api_client.delete_user, user['id']) for user in manifest['users']] +
+        [(databricks_api_client.delete_group, group['id']) for group in manifest['groups']])
+]
+
+# Run the deletes of each stage concurrently, and stop at the first stage with failures, as the
+# later stages depend on it
+teardown_workers = int(os.environ.get('AZDBX_TEARDOWN_WORKERS', '8'))
+teardown_start_time = time.time()
+with ThreadPoolExecutor(max_workers=teardown_workers) as executor:
+    for stage_name, deletes in teardown_stages:
+        print("Starting to tear down {} ({} deletes)".format(stage_name, len(deletes)))
+        start_time = time.time()
+        futures = [executor.submit(*delete) for delete in deletes]
+        failures = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures.append(e)
+        if failures:
+            for failure in failures:
+                print("Failed to tear down: {}".format(failure))
+            raise Exception("Failed to tear down {} with {} errors, please re-run the teardown".format(
+                stage_name, len(failures)))
+        print("Tore down {} in {} seconds".format(stage_name, str(int(time.time() - start_time))))
+print("Tore down all workspace objects in {} seconds".format(str(int(time.time() - teardown_start_time))))
+
+# All recorded objects are deleted, so reset the run manifest
+if os.path.isfile(databricks_api_client.run_manifest_path):
+    os.remove(databricks_api_client.run_manifest_path)
+print("Removed the run manifest {}".format(databricks_api_client.run_manifest_path))